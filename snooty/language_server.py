@@ -1,15 +1,31 @@
+import concurrent.futures
+import errno
 import logging
 import os
+import select
 import sys
 import threading
+import time
 import urllib.parse
+import orjson
 import pyls_jsonrpc.dispatchers
 import pyls_jsonrpc.endpoint
 import pyls_jsonrpc.streams
 from dataclasses import dataclass
 from functools import wraps
 from pathlib import Path, PurePath
-from typing import cast, Any, BinaryIO, Callable, Dict, List, Optional, Union, TypeVar
+from typing import (
+    cast,
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    TypeVar,
+)
 from .flutter import checked, check_type
 from .types import FileId, SerializableType
 from . import types, util
@@ -18,6 +34,12 @@ from .parser import Project
 _F = TypeVar("_F", bound=Callable[..., Any])
 Uri = str
 PARENT_PROCESS_WATCH_INTERVAL_SECONDS = 60
+DIAGNOSTICS_COALESCE_SECONDS = 0.03
+UPDATE_COALESCE_SECONDS = 0.2
+
+# Our response to the initialize request never changes. pyls_jsonrpc only
+# serializes it, so we can share one instance.
+_CAPABILITIES: SerializableType = {"capabilities": {"textDocumentSync": 1}}
 logger = logging.getLogger(__name__)
 
 
@@ -26,23 +48,74 @@ class debounce:
         self.wait = wait
 
     def __call__(self, fn: _F) -> _F:
+        # Rather than spawning a Timer thread for every call, a single worker
+        # thread sleeps until the most recent call's deadline has passed, and then
+        # invokes fn with that call's arguments.
         wait = self.wait
+        condition = threading.Condition()
+        deadline = 0.0
+        pending: Optional[Tuple[Tuple[Any, ...], Dict[str, Any]]] = None
+        worker: Optional[threading.Thread] = None
+        stopped = False
+
+        def run() -> None:
+            nonlocal pending
+            with condition:
+                while not stopped:
+                    if pending is None:
+                        condition.wait()
+                        continue
+
+                    remaining = deadline - time.monotonic()
+                    if remaining > 0:
+                        condition.wait(remaining)
+                        continue
+
+                    args, kwargs = pending
+                    pending = None
+                    condition.release()
+                    try:
+                        fn(*args, **kwargs)
+                    except Exception:
+                        logger.exception("Error in debounced function")
+                    finally:
+                        condition.acquire()
 
         @wraps(fn)
         def debounced(*args: Any, **kwargs: Any) -> Any:
-            def action() -> None:
-                fn(*args, **kwargs)
-
-            try:
-                getattr(debounced, "debounce_timer").cancel()
-            except AttributeError:
-                pass
-            timer = threading.Timer(wait, action)
-            setattr(debounced, "debounce_timer", timer)
-            timer.start()
-
+            nonlocal deadline, pending, worker
+            with condition:
+                if stopped:
+                    return
+
+                deadline = time.monotonic() + wait
+                pending = (args, kwargs)
+                if worker is None:
+                    worker = threading.Thread(
+                        target=run, name=f"debounce-{fn.__name__}", daemon=True
+                    )
+                    worker.start()
+                condition.notify()
+
+        def stop() -> None:
+            nonlocal pending, stopped
+            with condition:
+                pending = None
+                stopped = True
+                condition.notify()
+
+            if worker is not None and worker is not threading.current_thread():
+                worker.join()
+
+        setattr(debounced, "debounce_stop", stop)
         return cast(_F, debounced)
 
+    @staticmethod
+    def stop(debounced: Callable[..., Any]) -> None:
+        """Discard any pending call to a debounced function, and shut down its worker
+           thread. Subsequent calls are ignored."""
+        getattr(debounced, "debounce_stop")()
+
 
 @checked
 @dataclass
@@ -134,15 +207,226 @@ class TextDocumentEdit:
     edits: List[TextEdit]
 
 
+def _fast_did_change(
+    textDocument: SerializableType, contentChanges: SerializableType
+) -> Tuple[Uri, str]:
+    """Extract the document URI and new text from a textDocument/didChange
+       notification. We advertise full document sync, so a change normally has no
+       range and carries the complete text; read those fields directly rather than
+       building dataclasses with check_type, which is only used as a fallback."""
+    assert isinstance(textDocument, dict)
+    assert isinstance(contentChanges, list) and contentChanges
+    change = contentChanges[0]
+    if isinstance(change, dict) and "range" not in change:
+        uri, text = textDocument["uri"], change["text"]
+        if isinstance(uri, str) and isinstance(text, str):
+            return uri, text
+
+    identifier = check_type(VersionedTextDocumentIdentifier, textDocument)
+    parsed_change = check_type(TextDocumentContentChangeEvent, change)
+    return identifier.uri, parsed_change.text
+
+
+def _parse_file_uri(uri: Uri) -> str:
+    """Return the local path named by a file:// URI. This is much cheaper than
+       urllib.parse.urlparse(), since we needn't handle the general URI syntax."""
+    if not uri.startswith("file://"):
+        raise ValueError("Only file:// URIs may be resolved", uri)
+
+    path_start = uri.find("/", 7)
+    if path_start < 0:
+        raise ValueError("Invalid file URI", uri)
+
+    # file://localhost/foo is the same as file:///foo, but any other host names a
+    # remote file which we cannot open.
+    if uri[7:path_start] not in ("", "localhost"):
+        raise ValueError("Only local file:// URIs may be resolved", uri)
+
+    path = urllib.parse.unquote(uri[path_start:])
+
+    # On Windows, file:///C:/foo refers to C:/foo
+    if sys.platform == "win32" and path[2:3] == ":":
+        path = path[1:]
+
+    return path
+
+
 def pid_exists(pid: int) -> bool:
+    if hasattr(os, "pidfd_open"):
+        try:
+            os.close(os.pidfd_open(pid))
+        except ProcessLookupError:
+            return False
+        except OSError:
+            # e.g. EINVAL for pid 0, or a kernel without pidfd support
+            pass
+        else:
+            return True
+
     try:
         os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but belongs to somebody else
+        return True
     except OSError:
         return False
     else:
         return True
 
 
+def wait_for_process_exit(pid: int) -> None:
+    """Block until the given process exits. Raises OSError if the process does not
+       exist, or if this platform offers no way to wait on an arbitrary process."""
+    if hasattr(os, "pidfd_open"):
+        fd = os.pidfd_open(pid)
+        try:
+            poller = select.poll()
+            poller.register(fd, select.POLLIN)
+            poller.poll()
+        finally:
+            os.close(fd)
+    elif sys.platform == "darwin" or sys.platform.startswith("freebsd"):
+        kq = select.kqueue()
+        try:
+            event = select.kevent(
+                pid,
+                filter=select.KQ_FILTER_PROC,
+                flags=select.KQ_EV_ADD | select.KQ_EV_ONESHOT,
+                fflags=select.KQ_NOTE_EXIT,
+            )
+            kq.control([event], 1, None)
+        finally:
+            kq.close()
+    else:
+        raise OSError(errno.ENOSYS, "Cannot wait on process exit", pid)
+
+
+def watch_process(pid: int, on_exit: Callable[[], None]) -> None:
+    """Call on_exit from a daemon thread once the given process is no longer alive."""
+
+    def watch() -> None:
+        try:
+            wait_for_process_exit(pid)
+        except OSError:
+            # Fall back to periodically polling
+            while pid_exists(pid):
+                logger.debug("process %s is still alive", pid)
+                time.sleep(PARENT_PROCESS_WATCH_INTERVAL_SECONDS)
+
+        on_exit()
+
+    watching_thread = threading.Thread(target=watch, daemon=True)
+    watching_thread.start()
+
+
+def _log_future_exception(future: "concurrent.futures.Future[None]") -> None:
+    exception = future.exception()
+    if exception is not None:
+        logger.error("Error updating file", exc_info=exception)
+
+
+class FastJsonRpcStreamReader(pyls_jsonrpc.streams.JsonRpcStreamReader):
+    """A JsonRpcStreamReader which reads input in large chunks, locating message
+       headers with bytes.find() rather than reading them a line at a time, and
+       which decodes messages using orjson rather than the standard library json
+       module."""
+
+    CHUNK_SIZE = 64 * 1024
+    CONTENT_LENGTH = b"Content-Length:"
+
+    def __init__(self, rfile: BinaryIO) -> None:
+        super().__init__(rfile)
+        self._buffer = bytearray()
+
+        # Buffered streams let us read whatever is available without blocking until
+        # a full chunk arrives.
+        self._read: Callable[[int], bytes] = getattr(rfile, "read1", rfile.read)
+
+    def listen(self, message_consumer: Callable[[object], None]) -> None:
+        while not self._rfile.closed:
+            request_str = self._read_message()
+
+            if request_str is None:
+                break
+
+            try:
+                message_consumer(orjson.loads(request_str))
+            except ValueError:
+                logger.exception("Failed to parse JSON message %s", request_str)
+                continue
+
+    def _fill(self) -> bool:
+        """Read more input into the buffer. Returns False at EOF."""
+        data = self._read(self.CHUNK_SIZE)
+        if not data:
+            return False
+
+        self._buffer += data
+        return True
+
+    def _read_message(self) -> Optional[bytes]:
+        buffer = self._buffer
+
+        while True:
+            header_end = buffer.find(b"\r\n\r\n")
+            if header_end < 0:
+                if not self._fill():
+                    return None
+                continue
+
+            start = buffer.find(self.CONTENT_LENGTH, 0, header_end)
+            if start >= 0:
+                break
+
+            logger.error(
+                "Message missing Content-Length header: %s", buffer[:header_end]
+            )
+            del buffer[: header_end + 4]
+
+        start += len(self.CONTENT_LENGTH)
+        end = buffer.find(b"\r\n", start, header_end)
+        if end < 0:
+            end = header_end
+
+        try:
+            content_length = int(buffer[start:end])
+        except ValueError:
+            raise ValueError(f"Invalid Content-Length header: {buffer[start:end]!r}")
+
+        body_start = header_end + 4
+        body_end = body_start + content_length
+        while len(buffer) < body_end:
+            if not self._fill():
+                return None
+
+        body = bytes(buffer[body_start:body_end])
+        del buffer[:body_end]
+        return body
+
+
+class FastJsonRpcStreamWriter(pyls_jsonrpc.streams.JsonRpcStreamWriter):
+    """A JsonRpcStreamWriter which encodes messages using orjson, and which emits
+       each message's header and body with a single write."""
+
+    def write(self, message: object) -> None:
+        with self._wfile_lock:
+            if self._wfile.closed:
+                return
+
+            try:
+                body = orjson.dumps(message)
+                self._wfile.write(
+                    b"Content-Length: %d\r\n"
+                    b"Content-Type: application/vscode-jsonrpc; charset=utf8\r\n\r\n"
+                    b"%s" % (len(body), body)
+                )
+                self._wfile.flush()
+            except Exception:
+                logger.exception("Failed to write message to output file %s", message)
+
+
 class Backend:
     def __init__(self, server: "LanguageServer") -> None:
         self.server = server
@@ -167,20 +451,25 @@ class WorkspaceEntry:
     diagnostics: List[types.Diagnostic]
 
     def create_lsp_diagnostics(self) -> List[object]:
-        return [
-            {
-                "range": {
-                    "start": {
-                        "line": diagnostic.start[0],
-                        "character": diagnostic.start[1],
-                    },
-                    "end": {"line": diagnostic.end[0], "character": diagnostic.end[1]},
+        return create_lsp_diagnostics(self.diagnostics)
+
+
+def create_lsp_diagnostics(diagnostics: List[types.Diagnostic]) -> List[object]:
+    """Convert a list of diagnostics into the LSP's JSON representation."""
+    return [
+        {
+            "range": {
+                "start": {
+                    "line": diagnostic.start[0],
+                    "character": diagnostic.start[1],
                 },
-                "severity": diagnostic.severity,
-                "message": diagnostic.message,
-            }
-            for diagnostic in self.diagnostics
-        ]
+                "end": {"line": diagnostic.end[0], "character": diagnostic.end[1]},
+            },
+            "severity": diagnostic.severity,
+            "message": diagnostic.message,
+        }
+        for diagnostic in diagnostics
+    ]
 
 
 class LanguageServer(pyls_jsonrpc.dispatchers.MethodDispatcher):
@@ -189,12 +478,45 @@ class LanguageServer(pyls_jsonrpc.dispatchers.MethodDispatcher):
         self.workspace: Dict[str, WorkspaceEntry] = {}
         self.diagnostics: Dict[PurePath, List[types.Diagnostic]] = {}
 
-        self._jsonrpc_stream_reader = pyls_jsonrpc.streams.JsonRpcStreamReader(rx)
-        self._jsonrpc_stream_writer = pyls_jsonrpc.streams.JsonRpcStreamWriter(tx)
+        # Editors send the same handful of URIs over and over; avoid re-parsing
+        # and re-resolving them on every message.
+        self._uri_to_fileid_cache: Dict[Uri, FileId] = {}
+        self._fileid_to_uri_cache: Dict[FileId, Uri] = {}
+        self._uri_to_page_path: Dict[Uri, Path] = {}
+        self._source_path_str = ""
+        self._source_uri_prefix = ""
+
+        # Diagnostics are published in batches: set_diagnostics() only records them,
+        # and flush_diagnostics() sends everything recorded since the last flush.
+        # While _bulk is set (i.e. during a full project build), nothing is flushed
+        # until the build completes.
+        self._pending_diagnostics: Dict[FileId, List[types.Diagnostic]] = {}
+        self._pending_diagnostics_lock = threading.Lock()
+        self._schedule_diagnostics_flush = debounce(DIAGNOSTICS_COALESCE_SECONDS)(
+            self.flush_diagnostics
+        )
+        self._bulk = False
+
+        # Likewise, edits are recorded by didChange and reparsed in a batch once the
+        # client has been quiet for a moment.
+        self._pending_updates: Dict[Path, str] = {}
+        self._pending_updates_lock = threading.Lock()
+        self._schedule_updates_flush = debounce(UPDATE_COALESCE_SECONDS)(
+            self.flush_updates
+        )
+
+        self._jsonrpc_stream_reader = FastJsonRpcStreamReader(rx)
+        self._jsonrpc_stream_writer = FastJsonRpcStreamWriter(tx)
         self._endpoint = pyls_jsonrpc.endpoint.Endpoint(
             self, self._jsonrpc_stream_writer.write
         )
         self._shutdown = False
+        self._exited = False
+
+        # Reparsing a document can be slow, so do it off of the thread which reads
+        # messages from the client. A single worker keeps updates in the order
+        # they were received; Project serializes them in any case.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
     def start(self) -> None:
         self._jsonrpc_stream_reader.listen(self._endpoint.consume)
@@ -203,33 +525,96 @@ class LanguageServer(pyls_jsonrpc.dispatchers.MethodDispatcher):
         self, fileid: FileId, diagnostics: List[types.Diagnostic]
     ) -> None:
         self.diagnostics[fileid] = diagnostics
-        uri = self.fileid_to_uri(fileid)
-        workspace_item = self.workspace.get(uri, None)
-        if workspace_item is None:
-            workspace_item = WorkspaceEntry(fileid, uri, [])
-
-        workspace_item.diagnostics = diagnostics
-        self._endpoint.notify(
-            "textDocument/publishDiagnostics",
-            params={"uri": uri, "diagnostics": workspace_item.create_lsp_diagnostics()},
-        )
+        with self._pending_diagnostics_lock:
+            if self._exited:
+                return
+
+            self._pending_diagnostics[fileid] = diagnostics
+            if self._bulk:
+                return
+
+        self._schedule_diagnostics_flush()
+
+    def flush_diagnostics(self) -> None:
+        with self._pending_diagnostics_lock:
+            pending = self._pending_diagnostics
+            self._pending_diagnostics = {}
+
+        for fileid, diagnostics in pending.items():
+            uri = self.fileid_to_uri(fileid)
+            workspace_item = self.workspace.get(uri, None)
+            if workspace_item is not None:
+                workspace_item.diagnostics = diagnostics
+
+            self._endpoint.notify(
+                "textDocument/publishDiagnostics",
+                params={"uri": uri, "diagnostics": create_lsp_diagnostics(diagnostics)},
+            )
+
+    def flush_updates(self) -> None:
+        # Submit while holding the lock, so that a concurrent update_file() call
+        # cannot slip its reparse ahead of the stale edits being flushed here.
+        with self._pending_updates_lock:
+            pending = self._pending_updates
+            self._pending_updates = {}
+
+            for page_path, text in pending.items():
+                self._submit_update(page_path, text)
+
+    def update_file(self, page_path: Path, text: Optional[str] = None) -> None:
+        """Asynchronously reparse the given file, optionally using the provided text
+           rather than reading the file. Supersedes any pending edit to the file."""
+        with self._pending_updates_lock:
+            self._pending_updates.pop(page_path, None)
+            self._submit_update(page_path, text)
+
+    def _submit_update(self, page_path: Path, text: Optional[str]) -> None:
+        assert self.project is not None
+        future = self._executor.submit(self.project.update, page_path, text)
+        future.add_done_callback(_log_future_exception)
 
     def uri_to_fileid(self, uri: Uri) -> FileId:
         if not self.project:
             raise TypeError("Cannot map uri to fileid before a project is open")
 
-        parsed = urllib.parse.urlparse(uri)
-        if parsed.scheme != "file":
-            raise ValueError("Only file:// URIs may be resolved", uri)
-
-        path = Path(parsed.netloc).joinpath(Path(parsed.path)).resolve()
-        return self.project.get_fileid(path)
+        try:
+            return self._uri_to_fileid_cache[uri]
+        except KeyError:
+            pass
+
+        # Almost every URI we see points into the project's source directory; in
+        # that case, the FileId is just the remainder of the URI.
+        if self._source_uri_prefix and uri.startswith(self._source_uri_prefix):
+            relative = urllib.parse.unquote(uri[len(self._source_uri_prefix) :])
+            if ".." not in relative and not relative.startswith("/"):
+                fileid = FileId(relative)
+                self._uri_to_fileid_cache[uri] = fileid
+                return fileid
+
+        # The source path is fully resolved, so we only need to hit the filesystem
+        # if this path might be spelled differently: e.g. through a symlink, or
+        # with parent references.
+        unquoted = _parse_file_uri(uri)
+        path = Path(unquoted)
+        if ".." in unquoted or not unquoted.startswith(self._source_path_str):
+            path = path.resolve()
+
+        fileid = self.project.get_fileid(path)
+        self._uri_to_fileid_cache[uri] = fileid
+        return fileid
 
     def fileid_to_uri(self, fileid: FileId) -> str:
         if not self.project:
             raise TypeError("Cannot map fileid to uri before a project is open")
 
-        return "file://" + str(self.project.config.source_path.joinpath(fileid))
+        try:
+            return self._fileid_to_uri_cache[fileid]
+        except KeyError:
+            pass
+
+        uri = self._source_uri_prefix + urllib.parse.quote(str(fileid))
+        self._fileid_to_uri_cache[fileid] = uri
+        return uri
 
     def m_initialize(
         self,
@@ -237,32 +622,37 @@ class LanguageServer(pyls_jsonrpc.dispatchers.MethodDispatcher):
         rootUri: Optional[Uri] = None,
         **kwargs: object,
     ) -> SerializableType:
+        self._uri_to_fileid_cache.clear()
+        self._fileid_to_uri_cache.clear()
+        self._uri_to_page_path.clear()
+
         if rootUri:
-            root_path = Path(rootUri.replace("file://", "", 1))
+            root_path = Path(_parse_file_uri(rootUri))
             self.project = Project(root_path, Backend(self))
-            self.project.build()
+            self._source_path_str = (
+                self.project.config.source_path.as_posix().rstrip("/") + "/"
+            )
+            # Windows paths begin with a drive letter rather than a slash
+            uri_path = self._source_path_str
+            if not uri_path.startswith("/"):
+                uri_path = "/" + uri_path
+            self._source_uri_prefix = "file://" + urllib.parse.quote(uri_path)
+            self._bulk = True
+            try:
+                self.project.build()
+            finally:
+                self._bulk = False
+            self.flush_diagnostics()
 
         if processId is not None:
 
-            def watch_parent_process(pid: int) -> None:
-                # exist when the given pid is not alive
-                if not pid_exists(pid):
-                    logger.info("parent process %s is not alive", pid)
-                    self.m_exit()
-                logger.debug("parent process %s is still alive", pid)
-                threading.Timer(
-                    PARENT_PROCESS_WATCH_INTERVAL_SECONDS,
-                    watch_parent_process,
-                    args=[pid],
-                ).start()
-
-            watching_thread = threading.Thread(
-                target=watch_parent_process, args=(processId,)
-            )
-            watching_thread.daemon = True
-            watching_thread.start()
+            def on_parent_exit() -> None:
+                logger.info("parent process %s is not alive", processId)
+                self.m_exit()
+
+            watch_process(processId, on_parent_exit)
 
-        return {"capabilities": {"textDocumentSync": 1}}
+        return _CAPABILITIES
 
     def m_initialized(self, **kwargs: object) -> None:
         # Ignore this message to avoid logging a pointless warning
@@ -294,42 +684,58 @@ class LanguageServer(pyls_jsonrpc.dispatchers.MethodDispatcher):
         if not self.project:
             return
 
-        item = check_type(TextDocumentItem, textDocument)
-        fileid = self.uri_to_fileid(item.uri)
+        assert isinstance(textDocument, dict)
+        uri, text = textDocument["uri"], textDocument["text"]
+        fileid = self.uri_to_fileid(uri)
         page_path = self.project.get_full_path(fileid)
-        entry = WorkspaceEntry(fileid, item.uri, [])
-        self.workspace[item.uri] = entry
-        self.project.update(page_path, item.text)
+        entry = WorkspaceEntry(fileid, uri, [])
+        self.workspace[uri] = entry
+        self._uri_to_page_path[uri] = page_path
+        self.update_file(page_path, text)
 
-    @debounce(0.2)
     def m_text_document__did_change(
         self, textDocument: SerializableType, contentChanges: SerializableType
     ) -> None:
         if not self.project:
             return
 
-        identifier = check_type(VersionedTextDocumentIdentifier, textDocument)
-        page_path = self.project.get_full_path(self.uri_to_fileid(identifier.uri))
-        assert isinstance(contentChanges, list)
-        change = next(
-            check_type(TextDocumentContentChangeEvent, x) for x in contentChanges
-        )
-        self.project.update(page_path, change.text)
+        uri, text = _fast_did_change(textDocument, contentChanges)
+        try:
+            page_path = self._uri_to_page_path[uri]
+        except KeyError:
+            # Clients should open a document before changing it, but be lenient
+            page_path = self.project.get_full_path(self.uri_to_fileid(uri))
+
+        with self._pending_updates_lock:
+            self._pending_updates[page_path] = text
+
+        self._schedule_updates_flush()
 
     def m_text_document__did_close(self, textDocument: SerializableType) -> None:
         if not self.project:
             return
 
-        identifier = check_type(TextDocumentIdentifier, textDocument)
-        page_path = self.project.get_full_path(self.uri_to_fileid(identifier.uri))
-        del self.workspace[identifier.uri]
-        self.project.update(page_path)
+        assert isinstance(textDocument, dict)
+        uri = textDocument["uri"]
+        page_path = self._uri_to_page_path.pop(uri)
+        del self.workspace[uri]
+        self._uri_to_fileid_cache.pop(uri, None)
+        self.update_file(page_path)
 
     def m_shutdown(self, **_kwargs: object) -> None:
         self._shutdown = True
 
     def m_exit(self, **_kwargs: object) -> None:
+        debounce.stop(self._schedule_updates_flush)
+        debounce.stop(self._schedule_diagnostics_flush)
+        with self._pending_updates_lock:
+            self._pending_updates.clear()
+        with self._pending_diagnostics_lock:
+            self._exited = True
+            self._pending_diagnostics.clear()
+
         self._endpoint.shutdown()
+        self._executor.shutdown(wait=False)
         if self.project:
             self.project.stop_monitoring()
 
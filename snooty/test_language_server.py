@@ -1,7 +1,16 @@
+import concurrent.futures
+import errno
+import io
+import os
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 from dataclasses import dataclass
 from pathlib import Path
+from typing import cast, Any, BinaryIO, List, Tuple
+import pytest
 from . import language_server
 from .types import Diagnostic, FileId
 from .flutter import checked, check_type
@@ -48,12 +57,162 @@ def test_debounce() -> None:
     assert bounces[0] == 1
 
 
+def test_debounce_uses_latest_arguments() -> None:
+    seen = []
+
+    @language_server.debounce(0.1)
+    def record(value: int) -> None:
+        seen.append(value)
+
+    for i in range(5):
+        record(i)
+
+    time.sleep(0.2)
+    assert seen == [4]
+
+
+def test_debounce_stop() -> None:
+    bounces = [0]
+
+    @language_server.debounce(0.1)
+    def increment() -> None:
+        bounces[0] += 1
+
+    increment()
+    language_server.debounce.stop(increment)
+    increment()
+
+    time.sleep(0.2)
+    assert bounces[0] == 0
+    assert not any(t.name == "debounce-increment" for t in threading.enumerate())
+
+
 def test_pid_exists() -> None:
     assert language_server.pid_exists(0)
+    assert language_server.pid_exists(os.getpid())
     # Test that an invalid PID returns False
     assert not language_server.pid_exists(537920)
 
 
+def test_pid_exists_without_pidfd(monkeypatch: Any) -> None:
+    monkeypatch.delattr(os, "pidfd_open", raising=False)
+    assert language_server.pid_exists(os.getpid())
+    assert not language_server.pid_exists(537920)
+
+    def kill(pid: int, signal: int) -> None:
+        raise PermissionError(errno.EPERM, "Operation not permitted")
+
+    # A process owned by another user is still alive
+    monkeypatch.setattr(os, "kill", kill)
+    assert language_server.pid_exists(1)
+
+
+def test_wait_for_process_exit() -> None:
+    child = subprocess.Popen(["sleep", "0.1"])
+    try:
+        language_server.wait_for_process_exit(child.pid)
+    except OSError as err:
+        child.wait()
+        if err.errno == errno.ENOSYS:
+            # No pidfd_open (Python < 3.9 or Linux < 5.3) and no kqueue
+            pytest.skip("Cannot wait on process exit on this platform")
+        raise
+
+    assert child.wait(timeout=1) == 0
+
+    with pytest.raises(OSError):
+        language_server.wait_for_process_exit(537920)
+
+
+def test_stream_reader() -> None:
+    body = b'{"jsonrpc": "2.0", "method": "initialized", "params": {"x": "\\u00e9"}}'
+    rx = io.BytesIO(
+        b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
+        + b"Content-Length: 5\r\n\r\n{bad}"
+        + b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
+    )
+    messages: List[object] = []
+    language_server.FastJsonRpcStreamReader(rx).listen(messages.append)
+    expected = {"jsonrpc": "2.0", "method": "initialized", "params": {"x": "\u00e9"}}
+    assert messages == [expected, expected]
+
+
+def test_stream_reader_partial_reads() -> None:
+    class TrickleReader(io.RawIOBase):
+        """A stream which returns at most 3 bytes per read."""
+
+        def __init__(self, data: bytes) -> None:
+            self.data = data
+
+        def readable(self) -> bool:
+            return True
+
+        def readinto(self, b: Any) -> int:
+            n = min(3, len(b), len(self.data))
+            b[:n] = self.data[:n]
+            self.data = self.data[n:]
+            return n
+
+    body = b'{"id": 1}'
+    rx = TrickleReader(
+        b"Content-Type: application/vscode-jsonrpc; charset=utf-8\r\n"
+        + b"Content-Length: %d\r\n\r\n%s" % (len(body), body) * 2
+    )
+    messages: List[object] = []
+    language_server.FastJsonRpcStreamReader(cast(BinaryIO, rx)).listen(messages.append)
+    assert messages == [{"id": 1}, {"id": 1}]
+
+
+def test_fast_did_change() -> None:
+    document = {"uri": "file:///foo.rst", "version": 2}
+    assert language_server._fast_did_change(document, [{"text": "foo"}]) == (
+        "file:///foo.rst",
+        "foo",
+    )
+
+    # Changes with a range fall back to full validation
+    change = {
+        "range": {
+            "start": {"line": 0, "character": 0},
+            "end": {"line": 0, "character": 1},
+        },
+        "rangeLength": 1,
+        "text": "bar",
+    }
+    assert language_server._fast_did_change(document, [change]) == (
+        "file:///foo.rst",
+        "bar",
+    )
+
+
+def test_parse_file_uri() -> None:
+    assert language_server._parse_file_uri("file:///foo/bar%20baz.rst") == (
+        "/foo/bar baz.rst"
+    )
+    assert language_server._parse_file_uri("file://localhost/foo") == "/foo"
+
+    with pytest.raises(ValueError):
+        language_server._parse_file_uri("https://example.com/foo")
+
+    with pytest.raises(ValueError):
+        language_server._parse_file_uri("file://server/share/x.txt")
+
+
+def test_stream_writer() -> None:
+    tx = io.BytesIO()
+    writer = language_server.FastJsonRpcStreamWriter(tx)
+    writer.write({"jsonrpc": "2.0", "method": "foo", "params": {"x": "\u00e9"}})
+    writer.write({"jsonrpc": "2.0", "method": "bar"})
+
+    tx.seek(0)
+    messages: List[object] = []
+    language_server.FastJsonRpcStreamReader(tx).listen(messages.append)
+    assert messages == [
+        {"jsonrpc": "2.0", "method": "foo", "params": {"x": "\u00e9"}},
+        {"jsonrpc": "2.0", "method": "bar"},
+    ]
+
+
 def test_workspace_entry() -> None:
     entry = language_server.WorkspaceEntry(
         FileId(""), "", [Diagnostic.error("foo", 10), Diagnostic.warning("fo", 10, 12)]
@@ -75,6 +234,168 @@ def test_language_server() -> None:
         assert server.uri_to_fileid(
             CWD_URL + "/test_data/test_project/source/blah/bar.rst"
         ) == FileId("blah/bar.rst")
+        assert (
+            server.fileid_to_uri(FileId("blah/bar.rst"))
+            == CWD_URL + "/test_data/test_project/source/blah/bar.rst"
+        )
+        assert server.uri_to_fileid(
+            CWD_URL + "/test_data/test_project/source/blah/foo%20bar.rst"
+        ) == FileId("blah/foo bar.rst")
+        assert server.fileid_to_uri(FileId("blah/foo bar.rst")) == (
+            CWD_URL + "/test_data/test_project/source/blah/foo%20bar.rst"
+        )
+        assert server.uri_to_fileid(
+            CWD_URL + "/test_data/test_project/source/blah/../index.txt"
+        ) == FileId("index.txt")
+        assert server.uri_to_fileid(
+            "file://localhost"
+            + Path().resolve().as_posix()
+            + "/test_data/test_project/source/index.txt"
+        ) == FileId("index.txt")
+
+
+def test_symlinked_project() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        link = Path(tempdir, "proj")
+        link.symlink_to(Path("test_data/test_project").resolve())
+        link_url = "file://" + link.as_posix()
+
+        with language_server.LanguageServer(sys.stdin.buffer, io.BytesIO()) as server:
+            server.m_initialize(None, link_url)
+            assert server.uri_to_fileid(link_url + "/source/index.txt") == FileId(
+                "index.txt"
+            )
+            assert server.uri_to_fileid(
+                CWD_URL + "/test_data/test_project/source//blah/bar.rst"
+            ) == FileId("blah/bar.rst")
+
+
+def test_diagnostics_coalescing() -> None:
+    tx = io.BytesIO()
+    with language_server.LanguageServer(sys.stdin.buffer, tx) as server:
+        server.m_initialize(None, CWD_URL + "/test_data/test_project")
+        build_output = tx.getvalue()
+        assert build_output.count(b"textDocument/publishDiagnostics") > 0
+
+        for i in range(5):
+            server.set_diagnostics(FileId("index.txt"), [Diagnostic.error("foo", i)])
+
+        time.sleep(0.2)
+        output = tx.getvalue()[len(build_output) :]
+        assert output.count(b"textDocument/publishDiagnostics") == 1
+        assert b'"line":4' in output
+
+
+def test_document_sync() -> None:
+    with language_server.LanguageServer(sys.stdin.buffer, io.BytesIO()) as server:
+        server.m_initialize(None, CWD_URL + "/test_data/test_project")
+        assert server.project is not None
+
+        uri = CWD_URL + "/test_data/test_project/source/index.txt"
+        page_path = server.project.config.source_path.joinpath("index.txt")
+        server.m_text_document__did_open(
+            {"uri": uri, "languageId": "rst", "version": 1, "text": "foo"}
+        )
+        assert server._uri_to_page_path[uri] == page_path
+        assert uri in server.workspace
+
+        server.m_text_document__did_change(
+            {"uri": uri, "version": 2}, [{"text": "`foo <bar>`_"}]
+        )
+        time.sleep(0.3)
+
+        server.m_text_document__did_close({"uri": uri})
+        assert uri not in server._uri_to_page_path
+        assert uri not in server.workspace
+
+
+def test_update_coalescing() -> None:
+    with language_server.LanguageServer(sys.stdin.buffer, io.BytesIO()) as server:
+        server.m_initialize(None, CWD_URL + "/test_data/test_project")
+
+        uris = [
+            CWD_URL + "/test_data/test_project/source/" + filename
+            for filename in ("index.txt", "other.txt")
+        ]
+        for uri in uris:
+            server.m_text_document__did_open(
+                {"uri": uri, "languageId": "rst", "version": 1, "text": ""}
+            )
+
+        # Rapid edits to several files are all applied, each with its final text
+        for i in range(5):
+            for uri in uris:
+                server.m_text_document__did_change(
+                    {"uri": uri, "version": i + 2},
+                    [{"text": ".. bad-directive-{}::".format(i)}],
+                )
+
+        assert len(server._pending_updates) == 2
+        time.sleep(0.5)
+        assert not server._pending_updates
+
+        for fileid in (FileId("index.txt"), FileId("other.txt")):
+            diagnostics = server.diagnostics[fileid]
+            assert len(diagnostics) == 1
+            assert "bad-directive-4" in diagnostics[0].message
+
+
+def test_exit_discards_pending_work() -> None:
+    with language_server.LanguageServer(sys.stdin.buffer, io.BytesIO()) as server:
+        server.m_initialize(None, CWD_URL + "/test_data/test_project")
+        uri = CWD_URL + "/test_data/test_project/source/index.txt"
+        server.m_text_document__did_open(
+            {"uri": uri, "languageId": "rst", "version": 1, "text": ""}
+        )
+        server.m_text_document__did_change(
+            {"uri": uri, "version": 2}, [{"text": "foo"}]
+        )
+        server.set_diagnostics(FileId("index.txt"), [])
+
+    assert not server._pending_updates
+    assert not server._pending_diagnostics
+    worker_names = {"debounce-flush_updates", "debounce-flush_diagnostics"}
+    assert not any(t.name in worker_names for t in threading.enumerate())
+
+
+def test_close_during_update_flush() -> None:
+    """A didClose arriving while edits are being flushed must be applied after
+       them, or the project is left holding the closed buffer's text."""
+    submitted: List[Tuple[Path, object]] = []
+    closer: List[threading.Thread] = []
+
+    with language_server.LanguageServer(sys.stdin.buffer, io.BytesIO()) as server:
+
+        class RecordingExecutor(concurrent.futures.ThreadPoolExecutor):
+            def submit(self, fn: Any, *args: Any, **kwargs: Any) -> Any:  # type: ignore
+                if not closer and args[1] == "unsaved":
+                    # Race a didClose against the rest of this flush
+                    thread = threading.Thread(
+                        target=server.m_text_document__did_close, args=({"uri": uri},)
+                    )
+                    closer.append(thread)
+                    thread.start()
+                    time.sleep(0.2)
+
+                submitted.append((args[0], args[1]))
+                return super().submit(fn, *args, **kwargs)
+
+        server.m_initialize(None, CWD_URL + "/test_data/test_project")
+        assert server.project is not None
+        uri = CWD_URL + "/test_data/test_project/source/index.txt"
+        page_path = server.project.config.source_path.joinpath("index.txt")
+
+        server.m_text_document__did_open(
+            {"uri": uri, "languageId": "rst", "version": 1, "text": ""}
+        )
+        server._executor = RecordingExecutor(max_workers=1)
+        server.m_text_document__did_change(
+            {"uri": uri, "version": 2}, [{"text": "unsaved"}]
+        )
+        server.flush_updates()
+        closer[0].join()
+
+        assert submitted == [(page_path, "unsaved"), (page_path, None)]
 
 
 def test_text_doc_resolve() -> None:
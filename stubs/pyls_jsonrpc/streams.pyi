@@ -1,13 +1,20 @@
-from typing import BinaryIO, Callable
+import threading
+from typing import BinaryIO, Callable, Optional
 
 
 class JsonRpcStreamReader:
+    _rfile: BinaryIO
+
     def __init__(self, rfile: BinaryIO) -> None: ...
     def close(self) -> None: ...
     def listen(self, message_consumer: Callable[[object], None]) -> None: ...
+    def _read_message(self) -> Optional[bytes]: ...
 
 
 class JsonRpcStreamWriter:
+    _wfile: BinaryIO
+    _wfile_lock: threading.Lock
+
     def __init__(self, wfile: BinaryIO) -> None: ...
     def close(self) -> None: ...
     def write(self, message: object) -> None: ...
@@ -1,4 +1,5 @@
-from typing import Any, Type
+from typing import Any, NoReturn, Type
 
 
 def raises(exception: Type[Exception]) -> Any: ...
+def skip(msg: str) -> NoReturn: ...